@@ -24,10 +24,21 @@ class Settings(BaseSettings):
     # Image processing settings
     MAX_IMAGE_SIZE_MB: int = 10
     ALLOWED_IMAGE_TYPES: list = ["image/jpeg", "image/png", "image/gif", "image/webp"]
+    ANALYSIS_MAX_DIMENSION: int = os.getenv("ANALYSIS_MAX_DIMENSION", 512)
     
     # Moderation settings
     SAFETY_THRESHOLD: float = 0.7
     
+    # WebSocket moderation settings
+    WS_MAX_IN_FLIGHT: int = os.getenv("WS_MAX_IN_FLIGHT", 16)
+    WS_USAGE_BATCH_SIZE: int = os.getenv("WS_USAGE_BATCH_SIZE", 100)
+    WS_USAGE_FLUSH_SECONDS: float = os.getenv("WS_USAGE_FLUSH_SECONDS", 5.0)
+    
+    # Profiling settings
+    PROFILE_SAMPLE_RATE: float = os.getenv("PROFILE_SAMPLE_RATE", 0.0)
+    PROFILE_INTERVAL_MS: float = os.getenv("PROFILE_INTERVAL_MS", 5.0)
+    PROFILE_RETENTION_HOURS: int = os.getenv("PROFILE_RETENTION_HOURS", 24)
+    
     # Logging
     LOG_LEVEL: str = "INFO"
     
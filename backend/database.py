@@ -1,13 +1,19 @@
 # database.py
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne
 from datetime import datetime
 from typing import List, Optional, Dict, Any
+import hashlib
 import logging
 
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+def token_fingerprint(token: str) -> str:
+    """Short non-reversible token identifier for records that must not hold the secret"""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
 class Database:
     def __init__(self):
         self.client: Optional[AsyncIOMotorClient] = None
@@ -53,6 +59,20 @@ class Database:
             await self.db.usages.create_index([("token", 1), ("timestamp", -1)])
             await self.db.usages.create_index("timestamp")
             
+            # Stored verdicts are looked up by image hash
+            await self.db.moderations.create_index("image_hash", unique=True)
+            await self.db.reduced_moderations.create_index(
+                [("image_hash", 1), ("token", 1)],
+                unique=True
+            )
+            
+            # Request profiles expire automatically
+            await self.db.profiles.create_index("profile_id", unique=True)
+            await self.db.profiles.create_index(
+                "createdAt",
+                expireAfterSeconds=settings.PROFILE_RETENTION_HOURS * 3600
+            )
+            
             logger.info("Database indexes created successfully")
         except Exception as e:
             logger.warning(f"Error creating indexes: {e}")
@@ -99,8 +119,10 @@ class Database:
         result = await self.db.tokens.delete_one({"token": token})
         
         if result.deleted_count > 0:
-            # Also delete usage records for this token
+            # Also delete usage records, token-scoped verdicts and profiles for this token
             await self.db.usages.delete_many({"token": token})
+            await self.db.reduced_moderations.delete_many({"token": token})
+            await self.db.profiles.delete_many({"tokenFingerprint": token_fingerprint(token)})
             logger.info(f"Deleted token and its usage records")
             return True
         
@@ -128,6 +150,24 @@ class Database:
         # Update token's last used timestamp
         await self.update_token_last_used(token)
     
+    async def record_usage_batch(self, token: str, endpoint: str, metadata_list: List[Dict]):
+        """Record several API calls for one token in a single write"""
+        if not metadata_list:
+            return
+        
+        now = datetime.utcnow()
+        await self.db.usages.insert_many([
+            {
+                "token": token,
+                "endpoint": endpoint,
+                "timestamp": metadata.get("timestamp", now),
+                "metadata": {key: value for key, value in metadata.items() if key != "timestamp"}
+            }
+            for metadata in metadata_list
+        ], ordered=False)
+        
+        await self.update_token_last_used(token)
+    
     async def get_usage_stats(self, token: str, limit: int = 100) -> List[Dict[str, Any]]:
         """Get usage statistics for a token"""
         cursor = self.db.usages.find(
@@ -159,6 +199,67 @@ class Database:
             "endpointBreakdown": summary
         }
     
+    # Moderation verdict methods
+    async def save_moderation(self, result: Dict[str, Any], token: Optional[str] = None):
+        """
+        Store the latest verdict for an image hash.
+        
+        Verdicts from reduced uploads are keyed by a client-declared hash, so
+        they are scoped to the uploading token instead of being shared.
+        """
+        if token is None:
+            await self.db.moderations.replace_one(
+                {"image_hash": result["image_hash"]},
+                result,
+                upsert=True
+            )
+        else:
+            await self.db.reduced_moderations.replace_one(
+                {"image_hash": result["image_hash"], "token": token},
+                {**result, "token": token},
+                upsert=True
+            )
+    
+    async def save_moderations(self, results: List[Dict[str, Any]]):
+        """Store several shared verdicts in a single bulk write"""
+        if not results:
+            return
+        
+        await self.db.moderations.bulk_write([
+            ReplaceOne({"image_hash": result["image_hash"]}, result, upsert=True)
+            for result in results
+        ], ordered=False)
+    
+    async def get_moderation(self, image_hash: str, token: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Get the stored verdict for an image hash"""
+        result = await self.db.moderations.find_one({"image_hash": image_hash}, {"_id": 0})
+        if result is None and token is not None:
+            result = await self.db.reduced_moderations.find_one(
+                {"image_hash": image_hash, "token": token},
+                {"_id": 0, "token": 0}
+            )
+        return result
+    
+    # Profiling methods
+    async def save_profile(self, profile_doc: Dict[str, Any]) -> str:
+        """Store a request profile"""
+        profile_doc.setdefault("createdAt", datetime.utcnow())
+        await self.db.profiles.insert_one(profile_doc)
+        return profile_doc["profile_id"]
+    
+    async def get_profile(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        """Get a stored request profile"""
+        return await self.db.profiles.find_one({"profile_id": profile_id}, {"_id": 0})
+    
+    async def list_profiles(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """List stored request profiles without their samples"""
+        cursor = self.db.profiles.find(
+            {},
+            {"_id": 0, "stacks": 0}
+        ).sort("createdAt", -1).limit(limit)
+        
+        return await cursor.to_list(length=limit)
+    
     # Cleanup methods
     async def cleanup_old_usage_records(self, days: int = 30):
         """Clean up usage records older than specified days"""
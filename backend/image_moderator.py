@@ -25,7 +25,10 @@ class ImageModerator:
     - Custom ML models
     """
     
-    def __init__(self):
+    def __init__(self, max_dimension: int = 512):
+        # Images are analyzed at most at this resolution (longest side)
+        self.max_dimension = max_dimension
+        
         self.categories = [
             "violence",
             "nudity", 
@@ -49,13 +52,14 @@ class ImageModerator:
             "harassment": ["bullying", "threat", "intimidation"]
         }
         
-    async def moderate_image(self, image: Image.Image, image_hash: str) -> ModerationResult:
+    async def moderate_image(self, image: Image.Image, image_hash: str, offload: bool = False) -> ModerationResult:
         """
         Analyze an image for harmful content.
         
         Args:
             image: PIL Image object
             image_hash: SHA256 hash of the image
+            offload: Run decoding and pixel analysis in a worker thread
             
         Returns:
             ModerationResult with analysis results
@@ -63,12 +67,13 @@ class ImageModerator:
         start_time = time.time()
         
         try:
-            # Convert image to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            if offload:
+                image = await asyncio.to_thread(self._prepare_image, image)
+            else:
+                image = self._prepare_image(image)
             
             # Analyze image (this is a mock implementation)
-            categories = await self._analyze_image_content(image)
+            categories = await self._analyze_image_content(image, offload)
             
             # Calculate overall risk score
             risk_score = self._calculate_risk_score(categories)
@@ -95,7 +100,20 @@ class ImageModerator:
             logger.error(f"Error analyzing image {image_hash}: {str(e)}")
             raise
     
-    async def _analyze_image_content(self, image: Image.Image) -> List[ModerationCategory]:
+    def _prepare_image(self, image: Image.Image) -> Image.Image:
+        """Decode at the analysis resolution and convert to RGB"""
+        # Downscale to the analysis resolution (JPEG can decode at reduced size)
+        image.draft('RGB', (self.max_dimension, self.max_dimension))
+        if max(image.size) > self.max_dimension:
+            image.thumbnail((self.max_dimension, self.max_dimension))
+        
+        # Convert image to RGB if needed
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        
+        return image
+    
+    async def _analyze_image_content(self, image: Image.Image, offload: bool = False) -> List[ModerationCategory]:
         """
         Mock image analysis function.
         
@@ -106,6 +124,12 @@ class ImageModerator:
         # Add small delay to simulate processing
         await asyncio.sleep(0.1)
         
+        if offload:
+            return await asyncio.to_thread(self._analyze_pixels, image)
+        return self._analyze_pixels(image)
+    
+    def _analyze_pixels(self, image: Image.Image) -> List[ModerationCategory]:
+        """Score every category from pixel statistics (CPU-bound)"""
         categories = []
         
         # Get image properties for mock analysis
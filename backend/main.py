@@ -1,20 +1,24 @@
 # main.py
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile
+from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Request, Response, Path, Header, Query, WebSocket
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 import uvicorn
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
 import io
 from PIL import Image
 import hashlib
 import secrets
+import random
 import logging
 
-from database import Database
+from database import Database, token_fingerprint
 from models import TokenCreate, TokenResponse, ModerationResult, UsageRecord
 from image_moderator import ImageModerator
+from profiler import RequestProfiler, format_collapsed, to_speedscope
 from config import settings
 from rich.console import Console
 
@@ -25,7 +29,7 @@ logger = logging.getLogger(__name__)
 
 # Initialize components
 db = Database()
-image_moderator = ImageModerator()
+image_moderator = ImageModerator(settings.ANALYSIS_MAX_DIMENSION)
 security = HTTPBearer()
 
 @asynccontextmanager
@@ -99,6 +103,53 @@ async def get_admin_token(credentials: HTTPAuthorizationCredentials = Depends(se
     
     return token
 
+async def get_profiling_flag(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+) -> Optional[str]:
+    """Decide whether this request should be profiled and return the trigger"""
+    requested = (
+        request.headers.get("X-Profile", "").lower() in ("1", "true")
+        or request.query_params.get("profile", "").lower() in ("1", "true")
+    )
+    if requested:
+        # Only admins may force a profile; ignore the flag for everyone else
+        token_doc = await db.get_token(credentials.credentials)
+        if token_doc and token_doc.get("isAdmin", False):
+            return "admin"
+        logger.debug("Ignoring profiling flag from non-admin token")
+    
+    if settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE:
+        return "sampled"
+    
+    return None
+
+async def run_profiled(coro, endpoint: str, trigger: str, token: str, response: Response):
+    """Await coro under the sampling profiler and store the resulting profile"""
+    profiler = RequestProfiler(settings.PROFILE_INTERVAL_MS)
+    try:
+        return await profiler.run(coro)
+    finally:
+        profile_id = secrets.token_hex(8)
+        try:
+            await db.save_profile({
+                "profile_id": profile_id,
+                "endpoint": endpoint,
+                "trigger": trigger,
+                "tokenFingerprint": token_fingerprint(token),
+                "durationMs": profiler.duration_ms,
+                "intervalMs": settings.PROFILE_INTERVAL_MS,
+                "sampleCount": profiler.sample_count,
+                "stacks": [
+                    {"stack": stack, "count": count}
+                    for stack, count in profiler.stacks.items()
+                ]
+            })
+            response.headers["X-Profile-Id"] = profile_id
+            logger.info(f"Stored {trigger} profile {profile_id} for {endpoint} ({profiler.duration_ms}ms)")
+        except Exception as e:
+            logger.warning(f"Failed to store profile: {e}")
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -163,8 +214,16 @@ async def delete_token(
 # Moderation Endpoint
 @app.post("/moderate", response_model=ModerationResult)
 async def moderate_image(
+    response: Response,
     file: UploadFile = File(...),
-    token: str = Depends(get_current_token)
+    token: str = Depends(get_current_token),
+    profile_trigger: Optional[str] = Depends(get_profiling_flag),
+    original_hash: Optional[str] = Header(
+        default=None,
+        alias="X-Original-Image-Hash",
+        pattern="^[0-9a-fA-F]{64}$",
+        description="SHA256 of the original image when uploading a client-side reduced copy"
+    )
 ):
     """Analyze uploaded image for harmful content"""
     
@@ -185,35 +244,16 @@ async def moderate_image(
         )
     
     try:
-        # Validate image
-        image = Image.open(io.BytesIO(contents))
-        image.verify()
-        
-        # Re-open for processing (verify() closes the image)
-        image = Image.open(io.BytesIO(contents))
-        
-        # Generate image hash for tracking
-        image_hash = hashlib.sha256(contents).hexdigest()
+        if profile_trigger:
+            return await run_profiled(
+                process_image(contents, file, token, original_hash),
+                "moderate_image",
+                profile_trigger,
+                token,
+                response
+            )
         
-        # Perform moderation
-        result = await image_moderator.moderate_image(image, image_hash)
-        
-        # Record detailed usage
-        await db.record_usage(
-            token, 
-            "moderate_image",
-            metadata={
-                "filename": file.filename,
-                "content_type": file.content_type,
-                "file_size": len(contents),
-                "image_hash": image_hash,
-                "is_safe": result.is_safe
-            }
-        )
-        
-        logger.info(f"Image moderation completed: {image_hash}, safe: {result.is_safe}")
-        
-        return result
+        return await process_image(contents, file, token, original_hash)
         
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
@@ -222,6 +262,285 @@ async def moderate_image(
             detail=f"Invalid image file: {str(e)}"
         )
 
+async def process_image(
+    contents: bytes,
+    file: UploadFile,
+    token: str,
+    original_hash: Optional[str] = None
+) -> ModerationResult:
+    """Validate, moderate and record usage for uploaded image bytes"""
+    result, upload_hash = await moderate_contents(contents, token, original_hash)
+    image_hash = result.image_hash
+    
+    # Record detailed usage
+    await db.record_usage(
+        token, 
+        "moderate_image",
+        metadata={
+            "filename": file.filename,
+            "content_type": file.content_type,
+            "file_size": len(contents),
+            "image_hash": image_hash,
+            "upload_hash": upload_hash,
+            "reduced": bool(original_hash),
+            "is_safe": result.is_safe
+        }
+    )
+    
+    logger.info(f"Image moderation completed: {image_hash}, safe: {result.is_safe}")
+    
+    return result
+
+async def moderate_contents(
+    contents: bytes,
+    token: str,
+    original_hash: Optional[str] = None,
+    store: bool = True,
+    offload: bool = False
+) -> Tuple[ModerationResult, str]:
+    """
+    Validate and moderate image bytes and return the verdict with the upload hash.
+    
+    With ``store=False`` the caller is responsible for persisting the verdict
+    (the WebSocket channel batches them). With ``offload=True`` decoding and
+    analysis run in worker threads instead of on the event loop.
+    """
+    if offload:
+        image, upload_hash = await asyncio.to_thread(open_image, contents)
+    else:
+        image, upload_hash = open_image(contents)
+    
+    # Reduced uploads are tracked under the hash of the original image
+    image_hash = original_hash.lower() if original_hash else upload_hash
+    
+    # Perform moderation
+    result = await image_moderator.moderate_image(image, image_hash, offload)
+    
+    # Store verdict so clients can probe by hash before uploading again
+    if store:
+        await db.save_moderation(result.model_dump(), token=token if original_hash else None)
+    
+    return result, upload_hash
+
+def open_image(contents: bytes) -> Tuple[Image.Image, str]:
+    """Validate image bytes and return the opened image with its SHA256 hash"""
+    # Validate image
+    image = Image.open(io.BytesIO(contents))
+    image.verify()
+    
+    # Re-open for processing (verify() closes the image)
+    image = Image.open(io.BytesIO(contents))
+    
+    # Generate image hash for tracking
+    return image, hashlib.sha256(contents).hexdigest()
+
+@app.get("/moderate/config")
+async def moderation_config():
+    """Upload parameters for clients that prepare images before sending them"""
+    return {
+        "analysis_max_dimension": settings.ANALYSIS_MAX_DIMENSION,
+        "max_image_size_mb": settings.MAX_IMAGE_SIZE_MB,
+        "allowed_image_types": settings.ALLOWED_IMAGE_TYPES,
+        "original_hash_header": "X-Original-Image-Hash"
+    }
+
+@app.api_route("/moderate/{image_hash}", methods=["GET", "HEAD"], response_model=ModerationResult)
+async def get_moderation(
+    image_hash: str = Path(..., pattern="^[0-9a-fA-F]{64}$", description="SHA256 hash of the image"),
+    token: str = Depends(get_current_token)
+):
+    """Look up a stored verdict by image hash without uploading the image"""
+    result = await db.get_moderation(image_hash.lower(), token)
+    if not result:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No verdict stored for this image"
+        )
+    
+    return result
+
+# WebSocket Moderation Endpoint
+@app.websocket("/ws/moderate")
+async def moderate_websocket(websocket: WebSocket):
+    """
+    Persistent moderation channel for high-frequency clients.
+    
+    Authenticate once with an ``Authorization: Bearer`` header. Browsers,
+    which cannot set headers, offer the subprotocols ``moderation`` and
+    ``bearer.<token>``. Tokens are never read from the URL. Each binary frame is ``[1 byte id length][request id (UTF-8)][image bytes]``.
+    Results are sent back as JSON text frames tagged with ``request_id`` in
+    completion order. At most ``WS_MAX_IN_FLIGHT`` frames are processed at
+    once; the socket is not read while all slots are busy.
+    """
+    token = None
+    subprotocol = None
+    authorization = websocket.headers.get("authorization", "")
+    offered = [
+        protocol.strip()
+        for protocol in websocket.headers.get("sec-websocket-protocol", "").split(",")
+        if protocol.strip()
+    ]
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    else:
+        for protocol in offered:
+            if protocol.startswith("bearer."):
+                token = protocol[len("bearer."):]
+                break
+    
+    # Never echo the bearer subprotocol back; select the plain one instead
+    if "moderation" in offered:
+        subprotocol = "moderation"
+    
+    token_doc = await db.get_token(token) if token else None
+    if not token_doc:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept(subprotocol=subprotocol)
+    await db.record_usage(token, "websocket_connect")
+    
+    in_flight = asyncio.Semaphore(settings.WS_MAX_IN_FLIGHT)
+    send_lock = asyncio.Lock()
+    tasks = set()
+    pending_usage: List[Dict[str, Any]] = []
+    pending_verdicts: Dict[str, Dict[str, Any]] = {}
+    flush_lock = asyncio.Lock()
+    stop_flushing = asyncio.Event()
+    revoked = asyncio.Event()
+    max_size = settings.MAX_IMAGE_SIZE_MB * 1024 * 1024
+    
+    # Buffered records are bounded while MongoDB writes are failing
+    max_pending = settings.WS_USAGE_BATCH_SIZE * 4
+    next_flush_at = settings.WS_USAGE_BATCH_SIZE
+    
+    async def send(message: Dict[str, Any]):
+        try:
+            async with send_lock:
+                await websocket.send_json(message)
+        except Exception as e:
+            logger.debug(f"Dropping WebSocket message: {e}")
+    
+    async def handle_frame(request_id: str, contents: bytes):
+        try:
+            result, _ = await moderate_contents(contents, token, store=False, offload=True)
+            pending_verdicts[result.image_hash] = result.model_dump()
+            pending_usage.append({
+                "request_id": request_id,
+                "file_size": len(contents),
+                "image_hash": result.image_hash,
+                "is_safe": result.is_safe,
+                "timestamp": datetime.utcnow()
+            })
+            await send({"request_id": request_id, "result": result.model_dump(mode="json")})
+        except Exception as e:
+            logger.error(f"Error processing WebSocket frame {request_id}: {str(e)}")
+            await send({"request_id": request_id, "error": f"Invalid image file: {str(e)}"})
+        finally:
+            in_flight.release()
+    
+    async def flush_usage() -> bool:
+        """Write pending verdicts and usage records; returns False if the writes failed"""
+        async with flush_lock:
+            # Items are only dropped once written, so a failed flush is retried
+            try:
+                verdicts = dict(pending_verdicts)
+                await db.save_moderations(list(verdicts.values()))
+                for image_hash, verdict in verdicts.items():
+                    if pending_verdicts.get(image_hash) is verdict:
+                        del pending_verdicts[image_hash]
+                
+                # delete_token already removed this token's usages; don't recreate them
+                if not revoked.is_set() and await db.get_token(token) is None:
+                    revoked.set()
+                if revoked.is_set():
+                    pending_usage.clear()
+                    return True
+                
+                batch_size = len(pending_usage)
+                await db.record_usage_batch(token, "moderate_image_ws", pending_usage[:batch_size])
+                del pending_usage[:batch_size]
+                
+                return True
+            except Exception as e:
+                logger.warning(f"Failed to record WebSocket verdicts and usage: {e}")
+                return False
+    
+    async def flush_periodically():
+        while not stop_flushing.is_set():
+            try:
+                await asyncio.wait_for(stop_flushing.wait(), settings.WS_USAGE_FLUSH_SECONDS)
+                return
+            except asyncio.TimeoutError:
+                pass
+            await flush_usage()
+            if revoked.is_set():
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+    
+    flusher = asyncio.create_task(flush_periodically())
+    
+    try:
+        while True:
+            # Backpressure: wait for a free slot before reading the next frame
+            await in_flight.acquire()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                in_flight.release()
+                break
+            
+            data = message.get("bytes")
+            request_id = None
+            if data:
+                id_length = data[0]
+                request_id = data[1:1 + id_length].decode("utf-8", errors="replace")
+                contents = data[1 + id_length:]
+            
+            if not request_id:
+                in_flight.release()
+                await send({"request_id": None, "error": "Expected binary frame with a request id"})
+                continue
+            
+            if len(contents) > max_size:
+                in_flight.release()
+                await send({"request_id": request_id, "error": f"File too large. Maximum size is {settings.MAX_IMAGE_SIZE_MB}MB"})
+                continue
+            
+            task = asyncio.create_task(handle_frame(request_id, contents))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            
+            buffered = max(len(pending_usage), len(pending_verdicts))
+            if buffered < settings.WS_USAGE_BATCH_SIZE:
+                next_flush_at = settings.WS_USAGE_BATCH_SIZE
+            elif buffered >= next_flush_at:
+                if await flush_usage():
+                    next_flush_at = settings.WS_USAGE_BATCH_SIZE
+                elif buffered >= max_pending:
+                    logger.error("Closing WebSocket: usage buffer full and MongoDB writes failing")
+                    await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+                    break
+                else:
+                    # Retry once per further batch instead of stalling on every frame
+                    next_flush_at = buffered + settings.WS_USAGE_BATCH_SIZE
+                
+                if revoked.is_set():
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                    break
+    
+    except RuntimeError as e:
+        # Receiving after the socket was closed by the flusher
+        logger.debug(f"WebSocket receive stopped: {e}")
+    
+    finally:
+        # Let an in-progress periodic flush finish instead of cancelling its writes
+        stop_flushing.set()
+        await asyncio.gather(flusher, return_exceptions=True)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # Once revoked this only writes verdicts; usage is dropped
+        await flush_usage()
+
 @app.get("/usage/{token}")
 async def get_usage_stats(
     token: str,
@@ -245,6 +564,45 @@ async def get_usage_stats(
         "records": usage_records
     }
 
+# Profiling Endpoints (Admin-Only)
+@app.get("/admin/profiles", response_model=List[dict])
+async def list_profiles(
+    limit: int = 50,
+    _: str = Depends(get_admin_token)
+):
+    """List stored request profiles"""
+    return await db.list_profiles(limit)
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(
+    profile_id: str,
+    output_format: str = Query(default="speedscope", alias="format"),
+    _: str = Depends(get_admin_token)
+):
+    """Download a request profile as speedscope JSON or collapsed stacks"""
+    profile = await db.get_profile(profile_id)
+    if not profile:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profile not found"
+        )
+    
+    stacks = {entry["stack"]: entry["count"] for entry in profile.get("stacks", [])}
+    
+    if output_format == "collapsed":
+        return PlainTextResponse(format_collapsed(stacks))
+    if output_format == "speedscope":
+        return to_speedscope(
+            stacks,
+            profile.get("intervalMs", settings.PROFILE_INTERVAL_MS),
+            f"{profile['endpoint']} {profile_id}"
+        )
+    
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Format must be 'speedscope' or 'collapsed'"
+    )
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
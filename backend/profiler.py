@@ -0,0 +1,172 @@
+# profiler.py
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Awaitable, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RequestProfiler:
+    """
+    Sampling profiler scoped to a single request coroutine.
+
+    A background thread wakes up every ``interval_ms`` and records the stack
+    of the profiled coroutine. While the coroutine is suspended (e.g. waiting
+    on MongoDB), the stack is rebuilt from its await chain and ends in an
+    ``[await ...]`` frame, so off-CPU time shows up in the profile as well.
+    While it is running, the event loop thread's frames below the innermost
+    coroutine are appended.
+    """
+
+    def __init__(self, interval_ms: float = 5.0):
+        self.interval = max(interval_ms, 0.5) / 1000.0
+        self.stacks: Counter = Counter()
+        self.sample_count = 0
+        self.duration_ms = 0
+        self._coro = None
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+
+    async def run(self, coro: Awaitable[Any]) -> Any:
+        """Await ``coro`` while sampling its stack"""
+        self._coro = coro
+        self._thread_id = threading.get_ident()
+        sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+        start_time = time.perf_counter()
+        sampler.start()
+        try:
+            return await coro
+        finally:
+            self._stop.set()
+            sampler.join()
+            self.duration_ms = int((time.perf_counter() - start_time) * 1000)
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                stack = self._capture_stack()
+            except Exception as e:
+                # The await chain can change under our feet; drop the sample
+                logger.debug(f"Dropped profiler sample: {e}")
+                continue
+            if stack:
+                self.stacks[";".join(stack)] += 1
+                self.sample_count += 1
+
+    def _capture_stack(self) -> List[str]:
+        """Build a root-to-leaf stack for the profiled coroutine"""
+        stack = []
+        awaitable = self._coro
+        leaf_frame = None
+        running = False
+
+        while awaitable is not None:
+            frame = _awaitable_frame(awaitable)
+            if frame is None:
+                if awaitable is self._coro:
+                    # Not started yet or already finished
+                    return []
+                # Future, Task or other non-coroutine awaitable: we are waiting on it
+                stack.append(f"[await {_awaitable_name(awaitable)}]")
+                break
+            stack.append(_format_frame(frame))
+            leaf_frame = frame
+            running = _awaitable_running(awaitable)
+            awaitable = _awaitable_next(awaitable)
+        else:
+            if leaf_frame is not None and running:
+                stack.extend(self._frames_below(leaf_frame))
+
+        return stack
+
+    def _frames_below(self, leaf_frame) -> List[str]:
+        """Synchronous frames called from the running coroutine"""
+        frame = sys._current_frames().get(self._thread_id)
+        frames = []
+        while frame is not None and frame is not leaf_frame:
+            frames.append(_format_frame(frame))
+            frame = frame.f_back
+        if frame is None:
+            # Leaf coroutine is not on the thread's stack (it just yielded)
+            return []
+        frames.reverse()
+        return frames
+
+def _awaitable_frame(awaitable):
+    return (
+        getattr(awaitable, "cr_frame", None)
+        or getattr(awaitable, "gi_frame", None)
+        or getattr(awaitable, "ag_frame", None)
+    )
+
+def _awaitable_next(awaitable):
+    for attr in ("cr_await", "gi_yieldfrom", "ag_await"):
+        if hasattr(awaitable, attr):
+            return getattr(awaitable, attr)
+    return None
+
+def _awaitable_running(awaitable) -> bool:
+    for attr in ("cr_running", "gi_running", "ag_running"):
+        if hasattr(awaitable, attr):
+            return bool(getattr(awaitable, attr))
+    return False
+
+def _awaitable_name(awaitable) -> str:
+    name = type(awaitable).__name__
+    # ``await future`` suspends on the C future's iterator
+    return "Future" if name == "FutureIter" else name
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def format_collapsed(stacks: Dict[str, int]) -> str:
+    """Collapsed-stack text (one ``frame;frame;frame count`` line per stack)"""
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(stacks.items())) + "\n"
+
+def to_speedscope(stacks: Dict[str, int], interval_ms: float, name: str) -> Dict[str, Any]:
+    """Convert collapsed stacks into a speedscope sampled profile"""
+    frames: List[Dict[str, Any]] = []
+    frame_index: Dict[str, int] = {}
+    samples: List[List[int]] = []
+    weights: List[float] = []
+
+    for stack, count in sorted(stacks.items()):
+        sample = []
+        for label in stack.split(";"):
+            if label not in frame_index:
+                frame_index[label] = len(frames)
+                frames.append(_speedscope_frame(label))
+            sample.append(frame_index[label])
+        samples.append(sample)
+        weights.append(count * interval_ms)
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights
+        }],
+        "name": name,
+        "exporter": "image-moderation-api"
+    }
+
+def _speedscope_frame(label: str) -> Dict[str, Any]:
+    """Split ``name (file:line)`` labels back into speedscope frame fields"""
+    name, sep, location = label.rpartition(" (")
+    if not sep or not location.endswith(")"):
+        return {"name": label}
+    file, _, line = location[:-1].rpartition(":")
+    frame: Dict[str, Any] = {"name": name, "file": file}
+    if line.isdigit():
+        frame["line"] = int(line)
+    return frame
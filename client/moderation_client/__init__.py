@@ -0,0 +1,3 @@
+from .client import ModerationClient, ModerationError, guess_content_type, hash_bytes
+
+__all__ = ["ModerationClient", "ModerationError", "guess_content_type", "hash_bytes"]
@@ -0,0 +1,190 @@
+# client.py
+import asyncio
+import hashlib
+import mimetypes
+import os
+import random
+from typing import Any, Dict, Iterable, List, Optional, Union
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: rate limiting and transient upstream failures
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Hash large payloads off the event loop
+THREAD_HASH_THRESHOLD = 1024 * 1024
+
+class ModerationError(Exception):
+    """Raised when the API rejects a request"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+class ModerationClient:
+    """
+    Async client for the Image Moderation API.
+
+    Images are hashed locally and probed with ``GET /moderate/{image_hash}``;
+    the bytes are only uploaded when the server has no stored verdict.
+    A single keep-alive connection pool is shared by all requests, and
+    ``moderate_many`` bounds how many images are in flight at once.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        max_concurrency: int = 8,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        max_backoff: float = 30.0,
+        timeout: float = 30.0
+    ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency
+            )
+        )
+
+    async def __aenter__(self) -> "ModerationClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Close pooled connections"""
+        await self._client.aclose()
+
+    async def probe(self, image_hash: str) -> Optional[Dict[str, Any]]:
+        """Return the stored verdict for an image hash, or None if there is none"""
+        response = await self._request("GET", f"/moderate/{image_hash}")
+        if response.status_code == 404:
+            return None
+        return self._json(response)
+
+    async def upload(self, data: bytes, filename: str, content_type: str) -> Dict[str, Any]:
+        """Upload image bytes for moderation"""
+        response = await self._request(
+            "POST",
+            "/moderate",
+            files={"file": (filename, data, content_type)}
+        )
+        return self._json(response)
+
+    async def moderate_bytes(
+        self,
+        data: bytes,
+        filename: str = "image",
+        content_type: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Moderate image bytes, skipping the upload if the verdict is already known"""
+        if len(data) >= THREAD_HASH_THRESHOLD:
+            image_hash = await asyncio.to_thread(hash_bytes, data)
+        else:
+            image_hash = hash_bytes(data)
+
+        result = await self.probe(image_hash)
+        if result is not None:
+            logger.debug(f"Verdict cache hit: {image_hash}")
+            return result
+
+        content_type = content_type or guess_content_type(data, filename)
+        return await self.upload(data, filename, content_type)
+
+    async def moderate_file(self, path: Union[str, os.PathLike]) -> Dict[str, Any]:
+        """Moderate an image file from disk"""
+        data = await asyncio.to_thread(_read_file, path)
+        return await self.moderate_bytes(data, os.path.basename(path))
+
+    async def moderate_many(
+        self,
+        images: Iterable[Union[str, os.PathLike, bytes]],
+        return_exceptions: bool = True
+    ) -> List[Any]:
+        """
+        Moderate many images concurrently.
+
+        Items may be file paths or raw bytes. Results come back in input order;
+        with ``return_exceptions`` failed items hold their exception instead.
+        """
+        async def moderate_one(image):
+            async with self._semaphore:
+                if isinstance(image, (bytes, bytearray)):
+                    return await self.moderate_bytes(bytes(image))
+                return await self.moderate_file(image)
+
+        return await asyncio.gather(
+            *(moderate_one(image) for image in images),
+            return_exceptions=return_exceptions
+        )
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request, retrying transient failures with exponential backoff"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"{method} {url} failed ({e}), retrying")
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+
+            logger.warning(f"{method} {url} returned {response.status_code}, retrying")
+            await asyncio.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+
+        return response
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Delay before the next attempt (Retry-After wins when present), capped at max_backoff"""
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        delay = self.backoff_base * (2 ** attempt)
+        return min(delay + random.uniform(0, delay), self.max_backoff)
+
+    @staticmethod
+    def _json(response: httpx.Response) -> Dict[str, Any]:
+        if response.is_success:
+            return response.json()
+        try:
+            detail = response.json().get("detail", response.text)
+        except ValueError:
+            detail = response.text
+        raise ModerationError(response.status_code, str(detail))
+
+def hash_bytes(data: bytes) -> str:
+    """SHA256 hash used by the server as ``image_hash``"""
+    return hashlib.sha256(data).hexdigest()
+
+def guess_content_type(data: bytes, filename: str = "") -> str:
+    """Guess an image content type from magic bytes, falling back to the filename"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+def _read_file(path: Union[str, os.PathLike]) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()